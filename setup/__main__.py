@@ -6,6 +6,9 @@ from typing import Any, Dict
 
 from .utils import execute_command, load_configs
 from .commands_list import commands_list
+from .deploy import deploy
+from .discovery import discover, plan, print_plan
+from .watch import watch
 
 step_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "step")
 
@@ -83,6 +86,36 @@ def parse_args():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--plan",
+        help="probe the host & print what each selected step would change.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--converge",
+        help="probe the host & execute the not converged steps only.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--watch",
+        help="watch the project config/ dir, re-render & reload the changed configs.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--deploy",
+        help="deploy a new revision into a release dir & switch to it without downtime.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--revision",
+        help="the git revision to deploy, default: the remote default branch.",
+        default=None,
+    )
+
     parser.add_argument(
         "--list",
         help="list all steps & print the current last step",
@@ -283,13 +316,6 @@ if __name__ == "__main__":
             print("\n")
         sys.exit(0)
 
-    print(list(_commands.keys()))
-
-    proceed = input("press 'y' or 'Y' to continue, any key to abort: ")
-
-    if proceed.lower().strip() != "y":
-        sys.exit("Aborted by user")
-
     up = Up(
         commands=_commands,
         user=args.user,
@@ -300,4 +326,30 @@ if __name__ == "__main__":
         access_token=args.access,
     )
 
+    if args.deploy:
+        deploy(up, args.revision)
+        sys.exit(0)
+
+    if args.watch:
+        watch(up)
+        sys.exit(0)
+
+    if args.plan or args.converge:
+        state = discover(up)
+        steps_plan = plan(up, list(_commands.keys()), state)
+        print_plan(steps_plan, state["revision"])
+        if args.plan:
+            sys.exit(0)
+        up.commands = {s: c for s, c in _commands.items() if steps_plan[s]}
+        if not up.commands:
+            print("All steps are converged, Nothing to execute")
+            sys.exit(0)
+
+    print(list(up.commands.keys()))
+
+    proceed = input("press 'y' or 'Y' to continue, any key to abort: ")
+
+    if proceed.lower().strip() != "y":
+        sys.exit("Aborted by user")
+
     up.run()
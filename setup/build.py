@@ -0,0 +1,143 @@
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+
+from setup.utils import (
+    config_option,
+    execute_shell,
+    host_cpu_count,
+    host_meminfo,
+)
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+SWAPFILE = "/swapfile-aqar-build"
+
+# run the command & write the peak RSS of its biggest descendant (kB).
+MEASURE = """
+import resource, subprocess, sys
+rv = subprocess.run(sys.argv[2:]).returncode
+with open(sys.argv[1], "w") as f:
+    f.write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+sys.exit(rv)
+"""
+
+
+def build_history_path(caller):
+    return os.path.join(caller.home_dir, ".cache", "aqar-setup", "builds.json")
+
+
+def load_build_history(caller):
+    try:
+        with open(build_history_path(caller), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def record_build_peak(caller, name, peak):
+    history = load_build_history(caller)
+    history[name] = peak
+    path = build_history_path(caller)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2)
+
+
+def job_memory(caller, name):
+    """Memory needed by one compile job, the recorded peak of the last
+    build + 20%, or BUILD_JOB_MEMORY for the first build."""
+    recorded = load_build_history(caller).get(name)
+    if recorded:
+        return int(recorded * 1.2)
+    return config_option(caller, "BUILD_JOB_MEMORY", GB, int)
+
+
+def build_plan(caller, name):
+    """Return (jobs, missing memory in bytes) for the build `name`. The jobs
+    are sized from the RAM only, a job that swaps is slower than no job,
+    swap only covers what even these jobs can't get from the RAM."""
+    info = host_meminfo()
+    available = info.get("MemAvailable", info["MemFree"])
+    swap = info.get("SwapFree", 0)
+    per_job = job_memory(caller, name)
+    jobs = max(1, min(host_cpu_count(), available // per_job))
+    jobs = config_option(caller, "BUILD_JOBS", jobs, int)
+    missing = max(per_job * jobs - available - swap, 0)
+    print(
+        f"build {name}: {available // MB}MB RAM available, "
+        f"{swap // MB}MB swap free, {per_job // MB}MB per job, {jobs} jobs"
+    )
+    return jobs, missing
+
+
+def build_env(jobs, env=None):
+    env = dict(env or os.environ)
+    env.update({
+        "MAKEFLAGS": f"-j{jobs}",
+        "NPY_NUM_BUILD_JOBS": str(jobs),
+        "MAX_JOBS": str(jobs),
+        "CMAKE_BUILD_PARALLEL_LEVEL": str(jobs),
+        "POETRY_INSTALLER_MAX_WORKERS": str(jobs),
+    })
+    return env
+
+
+def add_swapfile(size):
+    # a swapfile left by an interrupted build.
+    remove_swapfile()
+    size_gb = max(math.ceil(size / GB), 1)
+    print(f"add a temporary {size_gb}GB swapfile {SWAPFILE}")
+    for command in (
+        ["sudo", "fallocate", "-l", f"{size_gb}G", SWAPFILE],
+        ["sudo", "chmod", "600", SWAPFILE],
+        ["sudo", "mkswap", SWAPFILE],
+        ["sudo", "swapon", SWAPFILE],
+    ):
+        if execute_shell(command).returncode != 0:
+            remove_swapfile()
+            raise Exception(f"Error: can't create the swapfile {SWAPFILE}")
+
+
+def remove_swapfile():
+    if not os.path.exists(SWAPFILE):
+        return
+    execute_shell(["sudo", "swapoff", SWAPFILE])
+    execute_shell(["sudo", "rm", "-f", SWAPFILE])
+    print(f"temporary swapfile {SWAPFILE} removed")
+
+
+def run_build(caller, name, command, env=None, cwd=None):
+    """Run the compile heavy `command` with a parallelism that fits the
+    memory, add a temporary swapfile if even one job doesn't fit, and
+    record the peak memory for the next builds."""
+    if isinstance(command, str):
+        command = command.split()
+    jobs, missing = build_plan(caller, name)
+    swap = missing > 0 and config_option(caller, "BUILD_SWAPFILE", True, bool)
+    if swap:
+        add_swapfile(missing)
+    fd, peak_path = tempfile.mkstemp(suffix=".peak")
+    os.close(fd)
+    try:
+        rv = subprocess.run(
+            [sys.executable, "-c", MEASURE, peak_path] + command,
+            env=build_env(jobs, env),
+            cwd=cwd,
+        )
+        with open(peak_path, "r") as f:
+            peak = int(f.read() or 0) * 1024
+    finally:
+        os.remove(peak_path)
+        if swap:
+            remove_swapfile()
+    if peak:
+        print(f"build {name}: peak memory {peak // MB}MB")
+        record_build_peak(caller, name, peak)
+    if rv.returncode != 0:
+        raise Exception(f"Error: build {name} failed: {' '.join(command)}")
+    return rv
@@ -3,7 +3,7 @@ from .utils import Command,  ShellCommand
 
 from setup.utils import (
     add_local_bin_path,
-    create_postgres_user,
+    config_option,
     install_poetry,
     resolve_template_file,
     shell_source,
@@ -12,8 +12,29 @@ from setup.utils import (
     confirm_proceed,
     user_choice,
     make_dir_if_not_exists,
-    wait_for_user_action,
 )
+from setup.build import run_build
+from setup.limits import apply_limits, show_limits_diff, verify_limits
+from setup.nginx import (
+    check_nginx_site,
+    install_nginx_performance,
+    nginx_context,
+)
+from setup.perf_profile import check_deploy
+from setup.postgres import (
+    create_postgres_user,
+    install_pgbouncer,
+    install_postgres_tuning,
+    pgbouncer_enabled,
+)
+from setup.redis import benchmark_redis, install_redis_conf
+from setup.static import precompress_static, static_root
+from setup.venv_cache import restore_venv_snapshot, save_venv_snapshot
+from setup.warmup import install_gunicorn_preload, warmup_daphne, warmup_gunicorn
+
+SYS_PACKAGES = (
+    "zlib1g-dev build-essential libreadline-gplv2-dev libncursesw5-dev libssl-dev libsqlite3-dev tk-dev libgdbm-dev libc6-dev libbz2-dev  python-setuptools python-pip python-smbus openssl libffi-dev python3-venv zip python3-distutils  software-properties-common redis postgresql postgresql-contrib libssl-dev curl python3-dev libpq-dev nginx nginx-common nginx-core git python-is-python3 binutils libproj-dev gdal-bin postgresql postgresql-contrib postgresql-client redis-server supervisor postgis postgresql-14-postgis-scripts postgresql-client-common certbot python3-certbot-nginx"
+).split()
 
 
 commands_list = {
@@ -37,16 +58,20 @@ commands_list = {
         lambda caller: os.chdir(caller.home_dir),
         "echo install system packages",
         Command(
-            [
-                f"sudo apt-get install -y {p}"
-                for p in (
-                    "zlib1g-dev build-essential libreadline-gplv2-dev libncursesw5-dev libssl-dev libsqlite3-dev tk-dev libgdbm-dev libc6-dev libbz2-dev  python-setuptools python-pip python-smbus openssl libffi-dev python3-venv zip python3-distutils  software-properties-common redis postgresql postgresql-contrib libssl-dev curl python3-dev libpq-dev nginx nginx-common nginx-core git python-is-python3 binutils libproj-dev gdal-bin postgresql postgresql-contrib postgresql-client redis-server supervisor postgis postgresql-14-postgis-scripts postgresql-client-common certbot python3-certbot-nginx"
-                ).split()
-            ],
+            [f"sudo apt-get install -y {p}" for p in SYS_PACKAGES],
             stop_in_error=False
         ),
         "echo packages installed successfully!",
     ],
+    "limits": [
+        lambda caller: caller.configs,
+        "echo sysctl & open files limits, changes:",
+        show_limits_diff,
+        confirm_proceed("limits", "Apply the above changes?"),
+        apply_limits,
+        "echo read back the live values",
+        verify_limits,
+    ],
     "pip": [
         "echo install pip",
         "curl https://bootstrap.pypa.io/get-pip.py -o get-pip.py",
@@ -63,13 +88,41 @@ commands_list = {
         lambda caller: shell_source("~/.profile"),
     ],
     "configs": [
-        "pip install dropbox python-dotenv",
+        "pip install dropbox python-dotenv brotli inotify_simple",
         lambda caller: caller.load_configs(),
     ],
     "postgres": [
         "echo create db_user",
         create_postgres_user,
     ],
+    "postgres_tune": [
+        lambda caller: caller.configs,
+        "echo install postgresql tuning drop-in",
+        install_postgres_tuning,
+        Command(
+            [
+                "echo install pgbouncer",
+                "sudo apt-get install -y pgbouncer",
+                install_pgbouncer,
+                "sudo systemctl enable pgbouncer",
+                "sudo systemctl restart pgbouncer",
+            ],
+            conditions=(pgbouncer_enabled,),
+        ),
+    ],
+    # before `env`, the performance profile points the cache, the sessions &
+    # the channel layers to the redis socket configured here.
+    "redis": [
+        lambda caller: caller.configs,
+        "echo tune /etc/redis/redis.conf",
+        install_redis_conf,
+        "echo allow the user to access the redis socket",
+        lambda caller: execute_shell(f"sudo usermod -aG redis {caller.user}"),
+        "sudo systemctl restart redis.service",
+        "sudo systemctl status redis --no-pager",
+        "echo benchmark redis",
+        benchmark_redis,
+    ],
     "clone": [
         lambda caller: caller.configs,
         # install repo from git
@@ -92,10 +145,20 @@ commands_list = {
         lambda caller: caller.configs,
         lambda caller: execute_shell(f"mkdir -p {caller.project_dir}"),
         lambda caller: os.chdir(caller.project_dir),
-        lambda caller: f"{caller.python_path} -m venv {caller.venv_path}",
+        "echo restore the venv snapshot of poetry.lock or build it",
+        Command(
+            [
+                lambda caller: execute_shell(
+                    f"python3 -m venv {caller.venv_path}"),
+                lambda caller: shell_source(os.path.join(
+                    caller.venv_path, "bin/activate")),
+                lambda caller: run_build(caller, "poetry", "poetry install"),
+                save_venv_snapshot,
+            ],
+            conditions=(lambda caller: not restore_venv_snapshot(caller),),
+        ),
         lambda caller: shell_source(os.path.join(
             caller.venv_path, "bin/activate")),
-        "poetry install",
     ],
     "shapely": [
         lambda caller: caller.configs,
@@ -104,14 +167,16 @@ commands_list = {
         lambda caller: execute_shell(
             f"{caller.pip_path} uninstall -y shapely"),
         "sudo apt install -y libgeos++-dev",
-        lambda caller: execute_shell(
-            f"{caller.pip_path} install --no-binary :all:  shapely"
+        lambda caller: run_build(
+            caller,
+            "shapely",
+            f"{caller.pip_path} install --no-binary :all:  shapely",
         ),
     ],
     "django": [
         lambda caller: caller.configs,
         lambda caller: make_dir_if_not_exists(
-            os.path.join(caller.proj_dir, "logs")),
+            os.path.join(caller.project_dir, "logs")),
         lambda caller:execute_shell(
             f"sudo chmod a+rw {os.path.join(caller.project_dir,'logs')}"),
         # execute_shell(f"mkdir -p {caller.project_dir}"),
@@ -120,8 +185,19 @@ commands_list = {
         lambda caller: execute_shell(
             f"{caller.python_path} manage.py makemigrations",
         ),
-        lambda caller: f"{caller.python_path} manage.py migrate",
-        lambda caller: f"{caller.python_path} manage.py collectstatic",
+        "echo run the django deploy checks",
+        check_deploy,
+        lambda caller: execute_shell(
+            f"{caller.python_path} manage.py migrate --noinput",
+        ),
+        lambda caller: execute_shell(
+            f"{caller.python_path} manage.py collectstatic --noinput",
+        ),
+        "echo precompress static files",
+        lambda caller: precompress_static(
+            static_root(caller),
+            config_option(caller, "STATIC_COMPRESS_WORKERS", None, int),
+        ),
         # create superuser
         lambda caller: user_choice(
             f"{caller.python_path} manage.py loaddata users",
@@ -207,6 +283,7 @@ commands_list = {
         lambda caller: execute_shell(
             f"sudo cp {os.path.join( caller.project_dir, 'config/gunicorn/gunicorn.service')} /etc/systemd/system/gunicorn.service"
         ),
+        install_gunicorn_preload,
 
         "echo moved !",
         "sudo systemctl daemon-reload",
@@ -222,6 +299,8 @@ commands_list = {
         "echo the presence of the socket",
         "file /run/gunicorn.sock",
         confirm_proceed("gunicorn", "Is the socket exists?"),
+        "echo warmup the gunicorn workers",
+        warmup_gunicorn,
         confirm_proceed(
             "gunicorn", "Is there is errors in `sudo journalctl -u gunicorn.socket`?"),
         "echo check gunicorn.service status",
@@ -244,17 +323,18 @@ commands_list = {
         lambda caller: make_dir_if_not_exists(caller.project_dir),
         lambda caller: os.chdir(caller.project_dir),
         lambda caller: make_dir_if_not_exists("/etc/nginx/sites-available/"),
+        "echo tune nginx.conf & generate the upstreams/static snippets",
+        install_nginx_performance,
         lambda caller: resolve_template_file(
-            "config/nginx/aqar.template", caller.context
+            "config/nginx/aqar.template",
+            {**caller.context, **nginx_context(caller)},
         ),
+        check_nginx_site,
         "echo copy aqar file to /etc/nginx/sites-available/",
         lambda caller: execute_shell(
             f"sudo cp {os.path.join(caller.project_dir, 'config/nginx/aqar')} /etc/nginx/sites-available/aqar"
         ),
         "echo copied",
-        lambda caller: wait_for_user_action(
-            "Go to /etc/nginx/nginx.conf & edit http { client_max_body_size 10M;  } or to another reasonable value, after this print enter"
-        ),
         Command(
             ["sudo rm -f /etc/nginx/sites-enabled/aqar"],
             [lambda caller: os.path.exists("/etc/nginx/sites-enabled/aqar")]
@@ -298,20 +378,6 @@ commands_list = {
         lambda caller: execute_shell(["sudo", "ufw", "allow", "nginx HTTPS"]),
         lambda caller: execute_shell(["sudo", "ufw", "allow", "Nginx Full"]),
     ],
-    "redis": [
-        lambda caller: wait_for_user_action(
-            """Navigate to /etc/redis/redis.conf
-               CTRL+F to find 'supervised no' and replace with ‘supervised systemd’ and SAVE .
-               """
-        ),
-        "sudo systemctl restart redis.service",
-        "echo check redis status: sudo systemctl status redis",
-        confirm_proceed("redis"),
-        "echo check redis port: sudo netstat -lnp | grep redis",
-        "sudo systemctl restart redis.service",
-        confirm_proceed(
-            "redis", "Check if the redis port is 6379"),
-    ],
     "daphne": [
         lambda caller: caller.configs,
         lambda caller: execute_shell(f"mkdir -p {caller.project_dir}"),
@@ -330,6 +396,8 @@ commands_list = {
         "sudo systemctl daemon-reload",
         "sudo systemctl start daphne.socket",
         "sudo systemctl enable daphne.socket",
+        "echo warmup daphne",
+        warmup_daphne,
         # "sudo systemctl status daphne.service",
         confirm_proceed(
             "daphne", "Check the daphne service status"),
@@ -0,0 +1,296 @@
+import ctypes
+import errno
+import filecmp
+import os
+import shutil
+import subprocess
+import time
+
+from setup.build import run_build
+from setup.nginx import nginx_options
+from setup.perf_profile import check_deploy
+from setup.static import precompress_static, static_root
+from setup.utils import config_option, execute_shell, unix_http_get
+from setup.venv_cache import (
+    relocate_venv,
+    restore_venv_snapshot,
+    save_venv_snapshot,
+)
+from setup.warmup import (
+    health_host,
+    warmup_daphne,
+    warmup_gunicorn,
+)
+
+# shared between the releases, they live in `releases/shared`.
+SHARED = ("media", "logs", ".env")
+
+# renameat2(2)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+
+class Release:
+    """Proxy of the caller (Up) that points the project paths to a release,
+    so the existing helpers work on the release dir."""
+
+    def __init__(self, caller, release_dir):
+        self._caller = caller
+        self.project_dir = release_dir
+        self.venv_path = os.path.join(
+            release_dir, caller.configs["VENV_DIRNAME"])
+        self.python_path = os.path.join(self.venv_path, "bin", "python3")
+        self.pip_path = os.path.join(self.venv_path, "bin", "pip")
+        self.env_path = os.path.join(release_dir, ".env")
+
+    def __getattr__(self, name):
+        return getattr(self._caller, name)
+
+
+def releases_dir(caller):
+    return config_option(
+        caller,
+        "DEPLOY_RELEASES_DIR",
+        os.path.join(
+            caller.home_dir, f"{caller.configs['PROJECT_DIRNAME']}-releases"),
+    )
+
+
+def _run(command, cwd=None):
+    rv = subprocess.run(command, cwd=cwd)
+    if rv.returncode != 0:
+        raise Exception(f"Error: {' '.join(command)}")
+    return rv
+
+
+def _output(command, cwd=None):
+    rv = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE)
+    return rv.returncode, bytes.decode(rv.stdout).strip()
+
+
+def switch_symlink(link, target):
+    """Point `link` to `target` atomically (rename over the old link)."""
+    tmp = f"{link}.tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+    print(f"{link} -> {target}")
+
+
+def exchange_paths(a, b):
+    """Swap the paths `a` & `b` atomically, both must exist on the same
+    filesystem."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    rv = libc.renameat2(
+        AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE)
+    if rv != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), a, None, b)
+
+
+def ensure_release_layout(caller):
+    """Convert the first time clone at `project_dir` to a release, the
+    shared files move to `releases/shared` & `project_dir` becomes the
+    `current` symlink, so the units & the nginx site keep their paths."""
+    project_dir = caller.project_dir
+    base = releases_dir(caller)
+    shared = os.path.join(base, "shared")
+    os.makedirs(shared, exist_ok=True)
+    if os.path.islink(project_dir):
+        return os.path.realpath(project_dir)
+    if not os.path.isdir(project_dir):
+        raise Exception(f"Error: {project_dir} not found, run the clone step")
+    if os.stat(base).st_dev != os.stat(project_dir).st_dev:
+        raise Exception(
+            f"Error: {base} & {project_dir} are on different filesystems, "
+            "the release layout can't be created without a downtime, "
+            "set DEPLOY_RELEASES_DIR on the same filesystem"
+        )
+    for name in SHARED:
+        source = os.path.join(project_dir, name)
+        if os.path.lexists(source) and not os.path.lexists(
+            os.path.join(shared, name)
+        ):
+            shutil.move(source, os.path.join(shared, name))
+    link_shared(caller, project_dir)
+
+    initial = os.path.join(base, "initial")
+    # a link at `initial` that points to itself, once swapped with the
+    # project dir, the link at `project_dir` resolves to the moved dir,
+    # there is no moment without a `project_dir`.
+    if os.path.lexists(initial):
+        raise Exception(f"Error: {initial} already exists")
+    os.symlink(initial, initial)
+    print(f"move {project_dir} to {initial}")
+    try:
+        exchange_paths(initial, project_dir)
+    except (AttributeError, OSError) as e:
+        os.remove(initial)
+        if isinstance(e, OSError) and e.errno not in (
+            errno.EINVAL, errno.ENOSYS):
+            raise
+        print(f"atomic rename not supported ({e}), move then link")
+        os.rename(project_dir, initial)
+        switch_symlink(project_dir, initial)
+    return initial
+
+
+def link_shared(caller, release_dir):
+    shared = os.path.join(releases_dir(caller), "shared")
+    for name in SHARED:
+        target = os.path.join(shared, name)
+        if name != ".env":
+            os.makedirs(target, exist_ok=True)
+        link = os.path.join(release_dir, name)
+        if os.path.lexists(link) and not os.path.islink(link):
+            if os.path.isdir(link):
+                shutil.rmtree(link)
+            else:
+                os.remove(link)
+        if not os.path.lexists(link):
+            os.symlink(target, link)
+
+
+def fetch_release(caller, current, revision=None):
+    """Clone `revision` (default: the remote default branch) next to the
+    current release, reusing its objects. Return (release dir, revision)."""
+    code, url = _output(["git", "-C", current, "remote", "get-url", "origin"])
+    if code != 0:
+        raise Exception(f"Error: {current} has no origin remote")
+    release = os.path.join(releases_dir(caller), time.strftime("%Y%m%d%H%M%S"))
+    try:
+        _run(["git", "clone", "--quiet", "--reference-if-able", current,
+              "--dissociate", url, release])
+        if revision:
+            _run(["git", "-C", release, "checkout", "--quiet", revision])
+    except BaseException:
+        # a bad revision, don't leave the clone in the releases dir.
+        if os.path.exists(release):
+            shutil.rmtree(release)
+        raise
+    return release, _output(["git", "-C", release, "rev-parse", "HEAD"])[1]
+
+
+def _same_file(a, b):
+    return os.path.exists(a) and os.path.exists(b) and filecmp.cmp(
+        a, b, shallow=False)
+
+
+def install_release_venv(caller, release, current):
+    """Install the dependencies only if poetry.lock changed, else reuse the
+    snapshot or a relocated copy of the current venv."""
+    if restore_venv_snapshot(release):
+        return
+    lock = "poetry.lock"
+    current_venv = os.path.join(current, os.path.basename(release.venv_path))
+    if _same_file(
+        os.path.join(release.project_dir, lock), os.path.join(current, lock)
+    ) and os.path.isdir(current_venv):
+        print("poetry.lock unchanged, copy the current venv")
+        shutil.copytree(current_venv, release.venv_path, symlinks=True)
+        # the services run the venv through the stable `project_dir` link,
+        # not through the real dir of a release.
+        relocate_venv(release.venv_path, {current: caller.project_dir})
+        return
+    print("poetry.lock changed, install the dependencies")
+    _run(["python3", "-m", "venv", release.venv_path])
+    env = dict(os.environ, VIRTUAL_ENV=release.venv_path)
+    env["PATH"] = os.path.join(release.venv_path, "bin") + ":" + env["PATH"]
+    run_build(caller, "poetry", "poetry install", env, release.project_dir)
+    save_venv_snapshot(release)
+
+
+def migrate_if_pending(release):
+    manage = [release.python_path, "manage.py"]
+    rv = subprocess.run(
+        manage + ["migrate", "--check"],
+        cwd=release.project_dir,
+        stdout=subprocess.DEVNULL,
+    )
+    if rv.returncode == 0:
+        print("no pending migrations")
+        return
+    _run(manage + ["migrate", "--noinput"], cwd=release.project_dir)
+
+
+def reload_services(caller):
+    """Restart gunicorn & daphne to load the new release. HUP is not enough,
+    the gunicorn master keeps the resolved (old) release dir as its chdir &
+    puts it back in sys.path of the new workers. gunicorn stops gracefully on
+    TERM & systemd keeps the sockets listening during the restart, the new
+    connections wait instead of being refused."""
+    execute_shell("sudo systemctl restart gunicorn.service")
+    execute_shell("sudo systemctl restart daphne.service")
+
+
+def health_check(caller, retries=10, delay=1):
+    opts = nginx_options(caller)
+    path = config_option(caller, "HEALTH_CHECK_PATH", "/")
+    host = health_host(caller)
+    for socket_path in (opts["gunicorn_socket"], opts["daphne_socket"]):
+        for attempt in range(retries):
+            try:
+                status, headers = unix_http_get(socket_path, path, host)
+            except OSError as e:
+                status = e
+            print(f"health check {socket_path}{path}: {status}")
+            if isinstance(status, int) and status < 500:
+                break
+            time.sleep(delay)
+        else:
+            return False
+    return True
+
+
+def prune_releases(caller, keep):
+    base = releases_dir(caller)
+    current = os.path.realpath(caller.project_dir)
+    releases = sorted(
+        os.path.join(base, name)
+        for name in os.listdir(base)
+        if name not in ("shared", "initial") and name.isdigit()
+    )
+    for release in releases[:-keep]:
+        if release != current:
+            print(f"remove old release {release}")
+            shutil.rmtree(release)
+
+
+def deploy(caller, revision=None):
+    current = ensure_release_layout(caller)
+    release_dir, new_revision = fetch_release(caller, current, revision)
+    current_revision = _output(["git", "-C", current, "rev-parse", "HEAD"])[1]
+    if new_revision == current_revision:
+        print(f"{new_revision} is already deployed")
+        shutil.rmtree(release_dir)
+        return
+    print(f"deploy {current_revision} -> {new_revision}")
+    release = Release(caller, release_dir)
+    try:
+        link_shared(caller, release_dir)
+        install_release_venv(caller, release, current)
+        _run([release.python_path, "manage.py", "collectstatic", "--noinput"],
+             cwd=release_dir)
+        precompress_static(static_root(release))
+        check_deploy(release)
+        migrate_if_pending(release)
+    except BaseException:
+        print(f"Error: the release {release_dir} is not activated, removed")
+        shutil.rmtree(release_dir)
+        raise
+
+    switch_symlink(caller.project_dir, release_dir)
+    reload_services(caller)
+    if not health_check(caller):
+        print("Error: health check failed, roll back")
+        switch_symlink(caller.project_dir, current)
+        reload_services(caller)
+        raise Exception(
+            f"Error: {new_revision} rolled back to {current_revision}, "
+            "the applied migrations are not reverted"
+        )
+    warmup_gunicorn(caller)
+    warmup_daphne(caller)
+    prune_releases(caller, config_option(caller, "DEPLOY_KEEP_RELEASES", 5, int))
+    print(f"{new_revision} deployed")
@@ -0,0 +1,364 @@
+import hashlib
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from setup import nginx
+from setup.limits import limits_files
+from setup.postgres import (
+    TUNING_CONF_NAME,
+    pgbouncer_enabled,
+    postgres_conf_dir,
+    postgres_settings,
+    render_postgres_settings,
+)
+from setup.redis import patch_redis_conf, redis_directives
+from setup.utils import (
+    config_option,
+    read_system_file,
+    render_env_file,
+    resolve_text,
+)
+from setup.warmup import PRELOAD_DROPIN, gunicorn_preload, gunicorn_preloaded
+
+HASHED_DIRS = ("/etc/systemd/system", "/etc/nginx")
+UNITS = (
+    "gunicorn.socket",
+    "gunicorn.service",
+    "daphne.socket",
+    "daphne.service",
+    "nginx.service",
+    "redis-server.service",
+    "postgresql.service",
+    "pgbouncer.service",
+)
+
+
+def _output(command):
+    rv = subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return rv.returncode, bytes.decode(rv.stdout).strip()
+
+
+def _sha256(content):
+    if isinstance(content, str):
+        content = content.encode()
+    return hashlib.sha256(content).hexdigest()
+
+
+def probe_packages():
+    """The installed dpkg packages."""
+    code, out = _output(
+        ["dpkg-query", "-W", "-f", "${Package} ${db:Status-Status}\\n"])
+    installed = set()
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == "installed":
+            installed.add(parts[0].split(":")[0])
+    return installed
+
+
+def probe_candidates(packages):
+    """The `packages` apt can install, the others have no candidate in the
+    configured sources (unknown names or virtual packages)."""
+    if not packages:
+        return set()
+    code, out = _output(["apt-cache", "policy"] + list(packages))
+    candidates = set()
+    package = None
+    for line in out.splitlines():
+        if not line.startswith(" ") and line.endswith(":"):
+            package = line[:-1].split(":")[0]
+        elif line.strip().startswith("Candidate:") and package:
+            if line.split(":", 1)[1].strip() != "(none)":
+                candidates.add(package)
+    return candidates
+
+
+def probe_unit(unit):
+    enabled = _output(["systemctl", "is-enabled", unit])[1] or "missing"
+    active = _output(["systemctl", "is-active", unit])[1] or "unknown"
+    return enabled, active
+
+
+def probe_file_hashes(root):
+    hashes = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path):
+                hashes[path] = _sha256(read_system_file(path))
+    return hashes
+
+
+def probe_revision(project_dir):
+    if not os.path.isdir(os.path.join(project_dir, ".git")):
+        return None
+    return _output(["git", "-C", project_dir, "rev-parse", "HEAD"])[1]
+
+
+def probe_postgres():
+    """The postgres roles & databases, None if postgres is unreachable."""
+    command = ["sudo", "-u", "postgres", "psql", "-X", "-tA", "-c"]
+    code, roles = _output(command + ["SELECT rolname FROM pg_roles"])
+    if code != 0:
+        return None
+    code, databases = _output(command + ["SELECT datname FROM pg_database"])
+    return {"roles": set(roles.split()), "databases": set(databases.split())}
+
+
+def discover(caller, workers=8):
+    """Probe the host state concurrently, return a dict of the results."""
+    # resolve the lazy properties here, they may prompt the user.
+    project_dir, venv_path = caller.project_dir, caller.venv_path
+    probes = {
+        "packages": (probe_packages,),
+        "revision": (probe_revision, project_dir),
+        "postgres": (probe_postgres,),
+        "redis_conf": (read_system_file, "/etc/redis/redis.conf"),
+    }
+    for unit in UNITS:
+        probes[f"unit:{unit}"] = (probe_unit, unit)
+    for root in HASHED_DIRS:
+        probes[f"files:{root}"] = (probe_file_hashes, root)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            name: pool.submit(probe[0], *probe[1:])
+            for name, probe in probes.items()
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    state = {
+        "packages": results["packages"],
+        "revision": results["revision"],
+        "postgres": results["postgres"],
+        "redis_conf": results["redis_conf"],
+        "units": {u: results[f"unit:{u}"] for u in UNITS},
+        "files": {},
+        "paths": {
+            project_dir: os.path.isdir(project_dir),
+            venv_path: os.path.exists(os.path.join(venv_path, "bin", "python")),
+        },
+    }
+    for root in HASHED_DIRS:
+        state["files"].update(results[f"files:{root}"])
+    return state
+
+
+def _file_changes(state, target, content):
+    current = state["files"].get(target)
+    if current is None:
+        return [f"create {target}"]
+    if current != _sha256(content):
+        return [f"update {target}"]
+    return []
+
+
+def _template_changes(caller, state, template, target, ctx=None):
+    path = os.path.join(caller.project_dir, template)
+    if not os.path.exists(path):
+        return [f"render {template} (not cloned yet)"]
+    with open(path, "r") as f:
+        content = resolve_text(f.read(), ctx or caller.context)
+    return _file_changes(state, target, content)
+
+
+def _unit_changes(state, unit):
+    enabled, active = state["units"][unit]
+    changes = []
+    if enabled != "enabled":
+        changes.append(f"enable {unit} ({enabled})")
+    if active != "active":
+        changes.append(f"start {unit} ({active})")
+    return changes
+
+
+def check_sys_install(caller, state):
+    from setup.commands_list import SYS_PACKAGES
+
+    missing = set(SYS_PACKAGES) - state["packages"]
+    # apt skips the names without a candidate, they never get installed.
+    return [f"install {p}" for p in sorted(probe_candidates(missing))]
+
+
+def check_pip(caller, state):
+    if os.path.exists(os.path.join(caller.home_dir, ".local/bin/pip")):
+        return []
+    return ["install pip"]
+
+
+def check_poetry(caller, state):
+    if os.path.exists(os.path.join(caller.home_dir, ".local/bin/poetry")):
+        return []
+    return ["install poetry"]
+
+
+def check_postgres(caller, state):
+    if state["postgres"] is None:
+        return ["postgres is unreachable, provision the database"]
+    changes = []
+    user = caller.configs["DB_USER"]
+    db_name = config_option(caller, "DB_NAME", "aqar")
+    if user not in state["postgres"]["roles"]:
+        changes.append(f"create role {user}")
+    if db_name not in state["postgres"]["databases"]:
+        changes.append(f"create database {db_name}")
+    return changes
+
+
+def check_postgres_tune(caller, state):
+    try:
+        path = os.path.join(postgres_conf_dir(), TUNING_CONF_NAME)
+    except Exception:
+        return ["postgresql is not installed"]
+    changes = []
+    content = render_postgres_settings(postgres_settings(caller))
+    if read_system_file(path) != content:
+        changes.append(f"write {path} & restart postgresql")
+    if pgbouncer_enabled(caller):
+        if "pgbouncer" not in state["packages"]:
+            changes.append("install pgbouncer")
+        changes += _unit_changes(state, "pgbouncer.service")
+    return changes
+
+
+def check_limits(caller, state):
+    return [
+        f"write {path}"
+        for path, content in limits_files(caller).items()
+        if read_system_file(path) != content
+    ]
+
+
+def check_clone(caller, state):
+    if state["revision"] is None:
+        return [f"clone into {caller.project_dir}"]
+    return []
+
+
+def check_env(caller, state):
+    if not os.path.exists(caller.env_path):
+        return [f"create {caller.env_path}"]
+    with open(caller.env_path, "r") as f:
+        if f.read() != render_env_file(caller):
+            return [f"update {caller.env_path}"]
+    return []
+
+
+def check_venv(caller, state):
+    if not state["paths"][caller.venv_path]:
+        return [f"create {caller.venv_path} & install the dependencies"]
+    return []
+
+
+def check_gunicorn(caller, state):
+    changes = _template_changes(
+        caller,
+        state,
+        "config/gunicorn/gunicorn.service.template",
+        "/etc/systemd/system/gunicorn.service",
+    )
+    changes += _template_changes(
+        caller,
+        state,
+        "config/gunicorn/gunicorn.socket",
+        "/etc/systemd/system/gunicorn.socket",
+    )
+    if gunicorn_preload(caller) != gunicorn_preloaded():
+        changes.append(f"update {PRELOAD_DROPIN}")
+    return changes + _unit_changes(state, "gunicorn.socket")
+
+
+def check_daphne(caller, state):
+    changes = _template_changes(
+        caller,
+        state,
+        "config/daphne/daphne.service.template",
+        "/etc/systemd/system/daphne.service",
+    )
+    changes += _template_changes(
+        caller,
+        state,
+        "config/daphne/daphne.socket",
+        "/etc/systemd/system/daphne.socket",
+    )
+    return changes + _unit_changes(state, "daphne.socket")
+
+
+def check_nginx(caller, state):
+    opts = nginx.nginx_options(caller)
+    current = read_system_file(nginx.NGINX_CONF)
+    changes = []
+    if not current:
+        return ["nginx is not installed"]
+    if nginx.patch_nginx_conf(current, opts) != current:
+        changes.append(f"patch {nginx.NGINX_CONF}")
+    changes += _file_changes(
+        state, nginx.UPSTREAMS_CONF, nginx.render_upstreams(opts))
+    changes += _file_changes(
+        state, nginx.PROXY_SNIPPET, nginx.render_proxy_snippet(opts))
+    changes += _file_changes(
+        state, nginx.STATIC_SNIPPET, nginx.render_static_snippet(opts))
+    changes += _template_changes(
+        caller,
+        state,
+        "config/nginx/aqar.template",
+        "/etc/nginx/sites-available/aqar",
+        {**caller.context, **nginx.nginx_context(caller)},
+    )
+    if "/etc/nginx/sites-enabled/aqar" not in state["files"]:
+        changes.append("enable the aqar site")
+    return changes + _unit_changes(state, "nginx.service")
+
+
+def check_redis(caller, state):
+    current = state["redis_conf"]
+    if not current:
+        return ["redis is not installed"]
+    if patch_redis_conf(current, redis_directives(caller)) != current:
+        return ["patch /etc/redis/redis.conf & restart redis"]
+    return []
+
+
+CHECKS = {
+    "sys_install": check_sys_install,
+    "limits": check_limits,
+    "pip": check_pip,
+    "poetry": check_poetry,
+    "postgres": check_postgres,
+    "postgres_tune": check_postgres_tune,
+    "clone": check_clone,
+    "env": check_env,
+    "venv": check_venv,
+    "gunicorn": check_gunicorn,
+    "nginx": check_nginx,
+    "redis": check_redis,
+    "daphne": check_daphne,
+}
+
+
+def plan(caller, steps, state=None):
+    """Return {step: [changes]}, an empty list means the step is converged.
+    The steps without a check always run."""
+    state = state or discover(caller)
+    rv = {}
+    for step in steps:
+        check = CHECKS.get(step)
+        if check is None:
+            rv[step] = ["no check, always runs"]
+        else:
+            rv[step] = check(caller, state)
+    return rv
+
+
+def print_plan(steps_plan, revision=None):
+    if revision:
+        print(f"project revision: {revision}")
+    for step, changes in steps_plan.items():
+        if not changes:
+            print(f"  {step}: converged")
+            continue
+        print(f"~ {step}:")
+        for change in changes:
+            print(f"    + {change}")
@@ -0,0 +1,178 @@
+import difflib
+import subprocess
+
+from setup.utils import (
+    config_option,
+    execute_shell,
+    install_file,
+    read_system_file,
+)
+
+SYSCTL_CONF = "/etc/sysctl.d/60-aqar.conf"
+THP_CONF = "/etc/tmpfiles.d/aqar-thp.conf"
+THP_PATHS = (
+    "/sys/kernel/mm/transparent_hugepage/enabled",
+    "/sys/kernel/mm/transparent_hugepage/defrag",
+)
+LIMITS_DROPIN = "aqar-limits.conf"
+
+SYSCTL_PROFILE = {
+    "net.core.somaxconn": 4096,
+    "net.core.netdev_max_backlog": 16384,
+    "net.ipv4.tcp_max_syn_backlog": 8192,
+    "net.ipv4.ip_local_port_range": "10240 65535",
+    "net.ipv4.tcp_tw_reuse": 1,
+    "net.ipv4.tcp_fin_timeout": 15,
+    # redis forks for the background saves.
+    "vm.overcommit_memory": 1,
+    "vm.swappiness": 10,
+    # no fs.file-max, systemd already raises it to the maximum, a value
+    # here would lower it. LimitNOFILE below is the per process limit.
+}
+
+LIMITED_UNITS = (
+    "gunicorn.service",
+    "daphne.service",
+    "nginx.service",
+    "redis-server.service",
+    "postgresql@.service",
+    "pgbouncer.service",
+)
+
+
+def sysctl_profile(caller):
+    """Every key can be overridden, example: SYSCTL_NET_CORE_SOMAXCONN=8192"""
+    profile = {}
+    for key, value in SYSCTL_PROFILE.items():
+        name = "SYSCTL_" + key.upper().replace(".", "_").replace("-", "_")
+        profile[key] = config_option(caller, name, value)
+    return profile
+
+
+def nofile_limit(caller):
+    return config_option(caller, "LIMIT_NOFILE", 65536, int)
+
+
+def thp_mode(caller):
+    return config_option(caller, "TRANSPARENT_HUGEPAGE", "never")
+
+
+def dropin_path(unit):
+    return f"/etc/systemd/system/{unit}.d/{LIMITS_DROPIN}"
+
+
+def limits_files(caller):
+    """{path: content} of the managed files."""
+    sysctl = ["# generated by aqar-setup, don't edit."]
+    sysctl += [f"{key} = {value}" for key, value in sysctl_profile(caller).items()]
+    thp = ["# generated by aqar-setup, don't edit."]
+    thp += [f"w {path} - - - - {thp_mode(caller)}" for path in THP_PATHS]
+    files = {
+        SYSCTL_CONF: "\n".join(sysctl) + "\n",
+        THP_CONF: "\n".join(thp) + "\n",
+    }
+    dropin = f"[Service]\nLimitNOFILE={nofile_limit(caller)}\n"
+    for unit in LIMITED_UNITS:
+        files[dropin_path(unit)] = dropin
+    return files
+
+
+def limits_diff(caller):
+    """Unified diff of the managed files, empty if everything is applied."""
+    diff = []
+    for path, content in limits_files(caller).items():
+        current = read_system_file(path)
+        diff += difflib.unified_diff(
+            current.splitlines(keepends=True),
+            content.splitlines(keepends=True),
+            fromfile=path if current else "/dev/null",
+            tofile=path,
+        )
+    return "".join(diff)
+
+
+def show_limits_diff(caller):
+    diff = limits_diff(caller)
+    print(diff or "The limits profile is already applied")
+
+
+def _read(command):
+    rv = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return bytes.decode(rv.stdout).strip()
+
+
+def active_units(unit):
+    """The running units of `unit`, the instances of a template unit."""
+    if unit.endswith("@.service"):
+        pattern = unit.replace("@.service", "@*.service")
+        listed = _read(["systemctl", "list-units", "--state=active",
+                        "--plain", "--no-legend", pattern])
+        return [line.split()[0] for line in listed.splitlines() if line]
+    if _read(["systemctl", "is-active", unit]) == "active":
+        return [unit]
+    return []
+
+
+def process_nofile(unit):
+    """The soft open files limit of the running main process of `unit`."""
+    pid = _read(["systemctl", "show", "--value", "-p", "MainPID", unit])
+    if not pid or pid == "0":
+        return None
+    try:
+        with open(f"/proc/{pid}/limits", "r") as f:
+            for line in f:
+                if line.startswith("Max open files"):
+                    return line.split()[3]
+    except FileNotFoundError:
+        return None
+
+
+def apply_limits(caller):
+    changed = [
+        path
+        for path, content in limits_files(caller).items()
+        if install_file(content, path)
+    ]
+    if SYSCTL_CONF in changed:
+        execute_shell(["sudo", "sysctl", "-p", SYSCTL_CONF])
+    if THP_CONF in changed:
+        execute_shell(["sudo", "systemd-tmpfiles", "--create", THP_CONF])
+    if any(path.endswith(LIMITS_DROPIN) for path in changed):
+        execute_shell("sudo systemctl daemon-reload")
+    # LimitNOFILE applies when the process starts, restart the running ones.
+    for unit in LIMITED_UNITS:
+        if dropin_path(unit) not in changed:
+            continue
+        for active in active_units(unit):
+            print(f"restart {active} to apply LimitNOFILE")
+            execute_shell(["sudo", "systemctl", "restart", active])
+
+
+def verify_limits(caller):
+    """Read back the live values, fail if one of them is not applied."""
+    errors = []
+    for key, value in sysctl_profile(caller).items():
+        live = " ".join(_read(["sysctl", "-n", key]).split())
+        expected = " ".join(str(value).split())
+        print(f"{key} = {live}")
+        if live != expected:
+            errors.append(f"{key}: {live} != {expected}")
+    for path in THP_PATHS:
+        live = _read(["cat", path])
+        print(f"{path}: {live}")
+        if f"[{thp_mode(caller)}]" not in live:
+            errors.append(f"{path}: {live}")
+    expected = str(nofile_limit(caller))
+    for unit in LIMITED_UNITS:
+        running = active_units(unit)
+        if not running:
+            # a stopped (or socket activated) unit gets the limit on start.
+            print(f"{unit} is not running, skip")
+            continue
+        for active in running:
+            live = process_nofile(active)
+            print(f"{active} max open files: {live}")
+            if live != expected:
+                errors.append(f"{active} max open files: {live}")
+    if errors:
+        raise Exception("Error: not applied, " + ", ".join(errors))
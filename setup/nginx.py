@@ -0,0 +1,354 @@
+import glob
+import os
+import re
+
+from setup.utils import (
+    config_option,
+    confirm_proceed,
+    execute_shell,
+    host_cpu_count,
+    install_file,
+    read_system_file,
+)
+from setup.static import static_root
+
+NGINX_CONF = "/etc/nginx/nginx.conf"
+NGINX_CANDIDATE = "/etc/nginx/nginx.conf.aqar-new"
+NGINX_BACKUP = "/etc/nginx/nginx.conf.aqar-bak"
+UPSTREAMS_CONF = "/etc/nginx/conf.d/aqar-upstreams.conf"
+STATIC_SNIPPET = "/etc/nginx/snippets/aqar-static.conf"
+PROXY_SNIPPET = "/etc/nginx/snippets/aqar-proxy.conf"
+
+GUNICORN_SOCKET = "/run/gunicorn.sock"
+DAPHNE_SOCKET = "/run/daphne.sock"
+
+# django ManifestStaticFilesStorage appends 12 hex chars to the file name.
+HASHED_STATIC_RE = r"\.[0-9a-f]{12}\.[a-zA-Z0-9]+$"
+
+
+def brotli_available():
+    return bool(glob.glob("/etc/nginx/modules-enabled/*brotli*"))
+
+
+def nginx_options(caller):
+    """The nginx options, every key can be overridden from the remote configs."""
+    cpus = host_cpu_count()
+    connections = config_option(
+        caller, "NGINX_WORKER_CONNECTIONS", 4096, int)
+    return {
+        "worker_processes": config_option(
+            caller, "NGINX_WORKER_PROCESSES", cpus, int),
+        "worker_connections": connections,
+        "worker_rlimit_nofile": config_option(
+            caller, "NGINX_WORKER_RLIMIT_NOFILE", connections * 2, int),
+        "client_max_body_size": config_option(
+            caller, "NGINX_CLIENT_MAX_BODY_SIZE", "10M"),
+        "keepalive_timeout": config_option(
+            caller, "NGINX_KEEPALIVE_TIMEOUT", 65, int),
+        "open_file_cache_max": config_option(
+            caller, "NGINX_OPEN_FILE_CACHE_MAX", 10000, int),
+        "upstream_keepalive": config_option(
+            caller, "NGINX_UPSTREAM_KEEPALIVE", 32, int),
+        "gunicorn_socket": config_option(
+            caller, "GUNICORN_SOCKET", GUNICORN_SOCKET),
+        "daphne_socket": config_option(caller, "DAPHNE_SOCKET", DAPHNE_SOCKET),
+        "static_url": config_option(caller, "STATIC_URL", "/static/"),
+        "static_root": static_root(caller),
+        "static_max_age": config_option(
+            caller, "NGINX_STATIC_MAX_AGE", 3600, int),
+        "brotli": config_option(caller, "NGINX_BROTLI", brotli_available(), bool),
+    }
+
+
+def nginx_context(caller):
+    """Extra keys for `config/nginx/aqar.template`:
+    `proxy_pass {{NGINX_GUNICORN_UPSTREAM}};` + `{{NGINX_PROXY_SNIPPET}}`
+    use the keepalive pools, `{{NGINX_STATIC_SNIPPET}}` serves the static files.
+    """
+    return {
+        "NGINX_GUNICORN_UPSTREAM": "http://aqar_gunicorn",
+        "NGINX_DAPHNE_UPSTREAM": "http://aqar_daphne",
+        "NGINX_PROXY_SNIPPET": f"include {PROXY_SNIPPET};",
+        "NGINX_STATIC_SNIPPET": f"include {STATIC_SNIPPET};",
+    }
+
+
+def check_nginx_site(caller):
+    """Warn if the rendered site doesn't use the keepalive upstreams or the
+    static snippet, an old template still passes to the sockets directly."""
+    path = os.path.join(caller.project_dir, "config/nginx/aqar")
+    with open(path, "r") as f:
+        site = f.read()
+    context = nginx_context(caller)
+    missing = [
+        key
+        for key in (
+            "NGINX_GUNICORN_UPSTREAM",
+            "NGINX_PROXY_SNIPPET",
+            "NGINX_STATIC_SNIPPET",
+        )
+        if context[key].replace("http://", "") not in site
+    ]
+    if not missing:
+        return True
+    confirm_proceed(
+        "nginx",
+        f"Warning: {path} doesn't use "
+        + ", ".join("{{" + key + "}}" for key in missing)
+        + ", the generated upstreams / snippets are not used by the site.",
+    )(caller)
+    return False
+
+
+def main_directives(opts):
+    return {
+        "worker_processes": opts["worker_processes"],
+        "worker_rlimit_nofile": opts["worker_rlimit_nofile"],
+    }
+
+
+def events_directives(opts):
+    return {
+        "worker_connections": opts["worker_connections"],
+        "multi_accept": "on",
+    }
+
+
+def http_directives(opts):
+    directives = {
+        "sendfile": "on",
+        "tcp_nopush": "on",
+        "tcp_nodelay": "on",
+        "keepalive_timeout": opts["keepalive_timeout"],
+        "client_max_body_size": opts["client_max_body_size"],
+        "open_file_cache": f"max={opts['open_file_cache_max']} inactive=60s",
+        "open_file_cache_valid": "120s",
+        "open_file_cache_min_uses": 2,
+        "open_file_cache_errors": "on",
+        "gzip": "on",
+        "gzip_static": "on",
+        "gzip_vary": "on",
+        "gzip_proxied": "any",
+        "gzip_comp_level": 5,
+        "gzip_min_length": 256,
+        "gzip_types": " ".join(COMPRESSIBLE_TYPES),
+    }
+    if opts["brotli"]:
+        directives.update({
+            "brotli": "on",
+            "brotli_static": "on",
+            "brotli_comp_level": 5,
+            "brotli_types": " ".join(COMPRESSIBLE_TYPES),
+        })
+    return directives
+
+
+COMPRESSIBLE_TYPES = (
+    "text/plain",
+    "text/css",
+    "text/xml",
+    "text/javascript",
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "application/rss+xml",
+    "image/svg+xml",
+    "font/ttf",
+    "font/otf",
+)
+
+
+def _directive_re(name):
+    return re.compile(
+        r"^([ \t]*)#?[ \t]*" + re.escape(name) + r"[ \t][^;\n]*;[^\n]*$",
+        re.MULTILINE,
+    )
+
+
+def _block_span(text, name):
+    """Return the (start, end) of the body of the top level block `name`."""
+    match = re.search(r"^[ \t]*" + name + r"\s*\{", text, re.MULTILINE)
+    if match is None:
+        raise Exception(f"Error: no `{name}` block in nginx.conf")
+    depth = 1
+    index = match.end()
+    while index < len(text) and depth:
+        char = text[index]
+        if char == "#":
+            index = text.find("\n", index)
+            if index == -1:
+                break
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        index += 1
+    return match.end(), index - 1
+
+
+def _top_level_matches(body, pattern):
+    """The matches of `pattern` that are directly in `body`, not in its
+    nested blocks (server, location, ...)."""
+    depths = []
+    depth = 0
+    offset = 0
+    for text_line in body.splitlines(keepends=True):
+        depths.append((offset, depth))
+        code = text_line.split("#", 1)[0]
+        depth += code.count("{") - code.count("}")
+        offset += len(text_line)
+    matches = []
+    for match in pattern.finditer(body):
+        line_depth = 0
+        for line_start, line_depth_at in depths:
+            if line_start > match.start():
+                break
+            line_depth = line_depth_at
+        if line_depth == 0:
+            matches.append(match)
+    return matches
+
+
+def set_directive(text, name, value, block=None):
+    """Set `name value;` in the main context or in `block`, uncommenting
+    or replacing the existing line, so applying it again changes nothing.
+    The nested blocks keep their own definitions."""
+    if block is None:
+        start, end = 0, len(text)
+        indent = ""
+    else:
+        start, end = _block_span(text, block)
+        indent = "\t"
+    body = text[start:end]
+    line = f"{name} {value};"
+    matches = _top_level_matches(body, _directive_re(name))
+    if matches:
+        # drop the duplicates, only the first definition is managed.
+        for match in reversed(matches[1:]):
+            stop = match.end()
+            if body[stop:stop + 1] == "\n":
+                stop += 1
+            body = body[: match.start()] + body[stop:]
+        first = matches[0]
+        body = (
+            body[: first.start()]
+            + (first.group(1) or indent)
+            + line
+            + body[first.end():]
+        )
+    elif block is None:
+        body = line + "\n" + body
+    else:
+        body = "\n" + indent + line + body
+    return text[:start] + body + text[end:]
+
+
+def patch_nginx_conf(text, opts):
+    # the missing directives are inserted at the block top, reverse the
+    # order so they keep the declared order.
+    for name, value in reversed(main_directives(opts).items()):
+        text = set_directive(text, name, value)
+    for name, value in reversed(events_directives(opts).items()):
+        text = set_directive(text, name, value, "events")
+    for name, value in reversed(http_directives(opts).items()):
+        text = set_directive(text, name, value, "http")
+    return text
+
+
+def render_upstreams(opts):
+    return f"""# generated by aqar-setup, don't edit.
+upstream aqar_gunicorn {{
+    server unix:{opts['gunicorn_socket']} fail_timeout=0;
+    keepalive {opts['upstream_keepalive']};
+}}
+
+upstream aqar_daphne {{
+    server unix:{opts['daphne_socket']} fail_timeout=0;
+    keepalive {opts['upstream_keepalive']};
+}}
+
+# keep the upstream connection alive unless the client asks for an upgrade.
+map $http_upgrade $aqar_connection_upgrade {{
+    default upgrade;
+    ''      '';
+}}
+"""
+
+
+def render_proxy_snippet(opts):
+    return """# generated by aqar-setup, don't edit.
+proxy_http_version 1.1;
+proxy_set_header Upgrade $http_upgrade;
+proxy_set_header Connection $aqar_connection_upgrade;
+proxy_set_header Host $host;
+proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+proxy_set_header X-Forwarded-Proto $scheme;
+proxy_redirect off;
+"""
+
+
+def render_static_snippet(opts):
+    static_url = "/" + opts["static_url"].strip("/") + "/"
+    root = opts["static_root"].rstrip("/")
+    brotli = "    brotli_static on;\n" if opts["brotli"] else ""
+    return f"""# generated by aqar-setup, don't edit.
+location {static_url} {{
+    alias {root}/;
+    gzip_static on;
+{brotli}    access_log off;
+    # no `expires`, it adds a second Cache-Control header.
+    add_header Cache-Control "public, max-age={opts['static_max_age']}";
+
+    # hashed names never change, cache them forever.
+    location ~* "^{static_url}(.+{HASHED_STATIC_RE})" {{
+        alias {root}/$1;
+        gzip_static on;
+{brotli and "    " + brotli}        access_log off;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }}
+}}
+"""
+
+
+def _restore(previous):
+    for path, content in previous.items():
+        if content:
+            install_file(content, path)
+        else:
+            execute_shell(["sudo", "rm", "-f", path])
+
+
+def install_nginx_performance(caller):
+    """Generate the snippets & patch nginx.conf, the patched nginx.conf is
+    installed only if `nginx -t` accepts it."""
+    opts = nginx_options(caller)
+    print("nginx options: ", opts)
+    generated = {
+        UPSTREAMS_CONF: render_upstreams(opts),
+        PROXY_SNIPPET: render_proxy_snippet(opts),
+        STATIC_SNIPPET: render_static_snippet(opts),
+    }
+    previous = {path: read_system_file(path) for path in generated}
+    for path, content in generated.items():
+        install_file(content, path)
+
+    current = read_system_file(NGINX_CONF)
+    if not current:
+        raise Exception(f"Error: {NGINX_CONF} not found, is nginx installed?")
+    patched = patch_nginx_conf(current, opts)
+
+    install_file(patched, NGINX_CANDIDATE)
+    rv = execute_shell(["sudo", "nginx", "-t", "-c", NGINX_CANDIDATE])
+    if rv.returncode != 0:
+        execute_shell(["sudo", "rm", "-f", NGINX_CANDIDATE])
+        _restore(previous)
+        raise Exception("Error: the generated nginx config is invalid")
+
+    if patched == current:
+        execute_shell(["sudo", "rm", "-f", NGINX_CANDIDATE])
+        print(f"{NGINX_CONF} is up to date")
+        return
+    if not os.path.exists(NGINX_BACKUP):
+        execute_shell(["sudo", "cp", NGINX_CONF, NGINX_BACKUP])
+    execute_shell(["sudo", "mv", NGINX_CANDIDATE, NGINX_CONF])
+    print(f"{NGINX_CONF} patched, backup: {NGINX_BACKUP}")
@@ -0,0 +1,44 @@
+import subprocess
+
+from setup.redis import redis_socket
+from setup.utils import config_option
+
+
+def performance_profile(caller):
+    """Tuned defaults merged under the remote configs by `write_env_file`,
+    a key of the remote configs overrides the same key here.
+    PERFORMANCE_PROFILE=off disables the profile on a host."""
+    if not config_option(caller, "PERFORMANCE_PROFILE", True, bool):
+        return {}
+    socket_path = redis_socket(caller)
+    return {
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
+        "CACHE_BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "CACHE_LOCATION": f"unix://{socket_path}?db=1",
+        "SESSION_ENGINE": "django.contrib.sessions.backends.cached_db",
+        "STATICFILES_STORAGE": (
+            "django.contrib.staticfiles.storage.ManifestStaticFilesStorage"
+        ),
+        "TEMPLATE_CACHED_LOADER": True,
+        "CHANNEL_LAYERS_HOST": f"unix://{socket_path}?db=2",
+    }
+
+
+def check_deploy(caller):
+    """Run `manage.py check --deploy` with the venv python, fail the step
+    on the messages of DEPLOY_CHECK_FAIL_LEVEL and above."""
+    level = config_option(caller, "DEPLOY_CHECK_FAIL_LEVEL", "ERROR")
+    rv = subprocess.run(
+        [
+            caller.python_path,
+            "manage.py",
+            "check",
+            "--deploy",
+            "--fail-level",
+            level,
+        ],
+        cwd=caller.project_dir,
+    )
+    if rv.returncode != 0:
+        raise Exception(f"Error: django deploy checks failed ({level})")
@@ -0,0 +1,225 @@
+import glob
+import os
+import subprocess
+
+from setup.utils import (
+    config_option,
+    execute_shell,
+    format_size,
+    host_cpu_count,
+    host_meminfo,
+    install_file,
+)
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+TUNING_CONF_NAME = "aqar-tuning.conf"
+PGBOUNCER_INI = "/etc/pgbouncer/pgbouncer.ini"
+PGBOUNCER_USERLIST = "/etc/pgbouncer/userlist.txt"
+PGBOUNCER_PORT = 6432
+POSTGRES_PORT = 5432
+
+# connect as the postgres superuser through the local unix socket,
+# a throwaway cluster can pass ["psql", "-h", socket_dir, "-U", "postgres"].
+POSTGRES_PSQL = ["sudo", "-u", "postgres", "psql"]
+
+PROVISION_SQL = r"""
+SELECT format('CREATE ROLE %I LOGIN PASSWORD %L', :'db_user', :'db_password')
+WHERE NOT EXISTS (SELECT FROM pg_roles WHERE rolname = :'db_user') \gexec
+SELECT format('CREATE DATABASE %I OWNER %I', :'db_name', :'db_user')
+WHERE NOT EXISTS (SELECT FROM pg_database WHERE datname = :'db_name') \gexec
+SELECT format('ALTER DATABASE %I OWNER TO %I', :'db_name', :'db_user') \gexec
+SELECT format('GRANT ALL PRIVILEGES ON DATABASE %I TO %I', :'db_name', :'db_user') \gexec
+\connect :"db_name"
+"""
+
+EXTENSION_SQL = r"""
+\set extension {extension}
+SELECT format('CREATE EXTENSION IF NOT EXISTS %I', :'extension') \gexec
+"""
+
+GRANTS_SQL = r"""
+SELECT format('GRANT ALL ON SCHEMA public TO %I', :'db_user') \gexec
+"""
+
+
+def postgres_conf_dir():
+    """Return the conf.d of the installed cluster, example:
+    /etc/postgresql/14/main/conf.d"""
+    clusters = sorted(
+        glob.glob("/etc/postgresql/*/main"),
+        key=lambda path: int(path.split("/")[3]),
+    )
+    if not clusters:
+        raise Exception("Error: no postgresql cluster in /etc/postgresql")
+    return os.path.join(clusters[-1], "conf.d")
+
+
+def _psql_literal(value):
+    """Quote `value` for a psql meta command, psql unescapes the backslashes
+    & the doubled quotes of the single quoted arguments."""
+    value = str(value).replace("\\", "\\\\").replace("'", "''")
+    return f"'{value}'"
+
+
+def provision_sql(db_name, db_user, db_password, extensions=()):
+    """The idempotent batch, the values are bound as psql variables and
+    quoted by the server (%I / %L), so they can't break the statements."""
+    script = [
+        f"\\set db_name {_psql_literal(db_name)}",
+        f"\\set db_user {_psql_literal(db_user)}",
+        f"\\set db_password {_psql_literal(db_password)}",
+        PROVISION_SQL,
+    ]
+    for extension in extensions:
+        script.append(EXTENSION_SQL.format(
+            extension=_psql_literal(extension)))
+    script.append(GRANTS_SQL)
+    return "\n".join(script)
+
+
+def provision_database(db_name, db_user, db_password, extensions=(), psql=None):
+    """Create the role, the database & the extensions in one psql session.
+    Existing objects are skipped, so it is safe to run it again.
+    The script is piped to psql, the password never touches the disk."""
+    command = list(psql or POSTGRES_PSQL) + [
+        "-X", "-q", "-v", "ON_ERROR_STOP=1", "-d", "postgres"
+    ]
+    rv = subprocess.run(
+        command,
+        input=provision_sql(
+            db_name, db_user, db_password, extensions).encode(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if rv.stdout:
+        print(bytes.decode(rv.stdout))
+    if rv.returncode != 0:
+        raise Exception(f"Error: {bytes.decode(rv.stderr)}")
+    return rv
+
+
+def create_postgres_user(caller):
+    extensions = config_option(caller, "DB_EXTENSIONS", "postgis")
+    provision_database(
+        config_option(caller, "DB_NAME", "aqar"),
+        caller.configs["DB_USER"],
+        caller.configs["DB_PASSWORD"],
+        [e.strip() for e in extensions.split(",") if e.strip()],
+    )
+
+
+def pgbouncer_enabled(caller):
+    return config_option(caller, "PGBOUNCER", False, bool)
+
+
+def postgres_settings(caller):
+    """Tuned settings sized from the host memory & cores, every setting can be
+    overridden with a `PG_<NAME>` key in the remote configs,
+    example: PG_SHARED_BUFFERS=1GB"""
+    memory = host_meminfo()["MemTotal"]
+    cpus = host_cpu_count()
+    # behind pgbouncer the server connections are the pool, not the clients.
+    max_connections = config_option(
+        caller,
+        "PG_MAX_CONNECTIONS",
+        50 if pgbouncer_enabled(caller) else 100,
+        int,
+    )
+    shared_buffers = memory // 4
+    work_mem = max((memory - shared_buffers) // (max_connections * 3), 4 * MB)
+    settings = {
+        "max_connections": max_connections,
+        "shared_buffers": format_size(shared_buffers),
+        "effective_cache_size": format_size(memory * 3 // 4),
+        "maintenance_work_mem": format_size(min(memory // 16, 2 * GB)),
+        "work_mem": format_size(work_mem),
+        "wal_buffers": "16MB",
+        "min_wal_size": "1GB",
+        "max_wal_size": "4GB",
+        "checkpoint_completion_target": 0.9,
+        "wal_compression": "on",
+        "random_page_cost": 1.1,
+        "effective_io_concurrency": 200,
+        "max_worker_processes": cpus,
+        "max_parallel_workers": cpus,
+        "max_parallel_workers_per_gather": max(cpus // 2, 1),
+    }
+    for name in settings:
+        settings[name] = config_option(
+            caller, f"PG_{name.upper()}", settings[name])
+    return settings
+
+
+def render_postgres_settings(settings):
+    lines = ["# generated by aqar-setup, don't edit."]
+    for name, value in settings.items():
+        if isinstance(value, str) and not value.replace(".", "").isdigit():
+            value = f"'{value}'"
+        lines.append(f"{name} = {value}")
+    return "\n".join(lines) + "\n"
+
+
+def install_postgres_tuning(caller):
+    settings = postgres_settings(caller)
+    print("postgres settings: ", settings)
+    path = os.path.join(postgres_conf_dir(), TUNING_CONF_NAME)
+    changed = install_file(render_postgres_settings(settings), path)
+    if changed:
+        # shared_buffers & max_connections need a restart, not a reload.
+        rv = execute_shell("sudo systemctl restart postgresql")
+        if rv.returncode != 0:
+            execute_shell(["sudo", "rm", "-f", path])
+            execute_shell("sudo systemctl restart postgresql")
+            raise Exception(
+                f"Error: postgresql refused {path}, the file is removed")
+
+
+def render_pgbouncer_ini(caller):
+    db_name = config_option(caller, "DB_NAME", "aqar")
+    pool_size = config_option(
+        caller, "PGBOUNCER_POOL_SIZE", host_cpu_count() * 2 + 1, int)
+    max_clients = config_option(caller, "PGBOUNCER_MAX_CLIENTS", 1000, int)
+    # pgbouncer runs as the postgres OS user, a unix socket login as DB_USER
+    # hits the `local all all peer` rule, tcp uses the scram `host` rule.
+    return f"""; generated by aqar-setup, don't edit.
+[databases]
+{db_name} = host=127.0.0.1 port={POSTGRES_PORT} dbname={db_name}
+
+[pgbouncer]
+listen_addr = 127.0.0.1
+listen_port = {PGBOUNCER_PORT}
+unix_socket_dir = /var/run/postgresql
+auth_type = scram-sha-256
+auth_file = {PGBOUNCER_USERLIST}
+pool_mode = transaction
+default_pool_size = {pool_size}
+reserve_pool_size = {max(pool_size // 4, 1)}
+max_client_conn = {max_clients}
+server_reset_query =
+ignore_startup_parameters = extra_float_digits
+logfile = /var/log/postgresql/pgbouncer.log
+pidfile = /var/run/postgresql/pgbouncer.pid
+"""
+
+
+def install_pgbouncer(caller):
+    install_file(render_pgbouncer_ini(caller), PGBOUNCER_INI, "640")
+    user = caller.configs["DB_USER"]
+    password = caller.configs["DB_PASSWORD"].replace('"', '""')
+    install_file(f'"{user}" "{password}"\n', PGBOUNCER_USERLIST, "640")
+    execute_shell(
+        ["sudo", "chown", "postgres:postgres", PGBOUNCER_INI, PGBOUNCER_USERLIST])
+
+
+def pgbouncer_env(caller):
+    """The pooled connection settings written to the `.env`.
+    Transaction pooling can't keep server side cursors across transactions."""
+    if not pgbouncer_enabled(caller):
+        return {}
+    return {
+        "DB_HOST": "127.0.0.1",
+        "DB_PORT": PGBOUNCER_PORT,
+        "DB_DISABLE_SERVER_SIDE_CURSORS": True,
+    }
@@ -0,0 +1,178 @@
+import csv
+import os
+import re
+import socket
+import subprocess
+import time
+
+from setup.utils import (
+    config_option,
+    execute_shell,
+    host_meminfo,
+    install_file,
+    read_system_file,
+)
+
+MB = 1024 ** 2
+
+REDIS_CONF = "/etc/redis/redis.conf"
+REDIS_BACKUP = "/etc/redis/redis.conf.aqar-bak"
+REDIS_SOCKET = "/run/redis/redis-server.sock"
+
+PERSISTENCE = {
+    "none": {"save": ['""'], "appendonly": ["no"]},
+    "rdb": {"save": ["3600 1", "300 100", "60 10000"], "appendonly": ["no"]},
+    "aof": {
+        "save": ['""'],
+        "appendonly": ["yes"],
+        "appendfsync": ["everysec"],
+    },
+}
+
+
+def redis_socket(caller):
+    return config_option(caller, "REDIS_SOCKET", REDIS_SOCKET)
+
+
+def redis_directives(caller):
+    """The managed redis.conf directives, the values are lists because
+    some directives (save) are repeated on many lines."""
+    memory = host_meminfo()["MemTotal"]
+    maxmemory = config_option(
+        caller, "REDIS_MAXMEMORY", f"{max(memory // 8 // MB, 64)}mb")
+    persistence = config_option(caller, "REDIS_PERSISTENCE", "rdb")
+    if persistence not in PERSISTENCE:
+        raise Exception(
+            f"Error: REDIS_PERSISTENCE should be one of {list(PERSISTENCE)}")
+    directives = {
+        "supervised": ["systemd"],
+        "bind": ["127.0.0.1 ::1"],
+        "port": [config_option(caller, "REDIS_PORT", 6379, int)],
+        "tcp-backlog": [config_option(caller, "REDIS_TCP_BACKLOG", 1024, int)],
+        "unixsocket": [redis_socket(caller)],
+        "unixsocketperm": ["770"],
+        "maxmemory": [maxmemory],
+        "maxmemory-policy": [
+            config_option(caller, "REDIS_MAXMEMORY_POLICY", "allkeys-lru")
+        ],
+    }
+    directives.update(PERSISTENCE[persistence])
+    return directives
+
+
+def set_redis_directive(text, name, values):
+    """Replace every `name` line by `name value` lines, at the place of the
+    first active or commented definition, or append them at the end."""
+    lines = text.splitlines()
+    active = re.compile(r"^\s*" + re.escape(name) + r"(\s|$)")
+    commented = re.compile(r"^\s*#\s*" + re.escape(name) + r"\s")
+    new_lines = [f"{name} {value}" for value in values]
+
+    position = None
+    for index, line in enumerate(lines):
+        if active.match(line):
+            position = index
+            break
+    if position is None:
+        for index, line in enumerate(lines):
+            if commented.match(line):
+                position = index + 1
+                break
+
+    kept = []
+    for index, line in enumerate(lines):
+        if index == position:
+            kept.extend(new_lines)
+        if not active.match(line):
+            kept.append(line)
+    if position is None or position >= len(lines):
+        kept.extend(new_lines)
+    return "\n".join(kept) + "\n"
+
+
+def patch_redis_conf(text, directives):
+    for name, values in directives.items():
+        text = set_redis_directive(text, name, values)
+    return text
+
+
+def install_redis_conf(caller):
+    current = read_system_file(REDIS_CONF)
+    if not current:
+        raise Exception(f"Error: {REDIS_CONF} not found, is redis installed?")
+    patched = patch_redis_conf(current, redis_directives(caller))
+    if patched == current:
+        print(f"{REDIS_CONF} is up to date")
+        return
+    if not os.path.exists(REDIS_BACKUP):
+        execute_shell(["sudo", "cp", "-p", REDIS_CONF, REDIS_BACKUP])
+    install_file(patched, REDIS_CONF, "640")
+    execute_shell(["sudo", "chown", "redis:redis", REDIS_CONF])
+
+
+def _redis_connection(caller):
+    path = redis_socket(caller)
+    if os.access(path, os.R_OK | os.W_OK):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+    else:
+        port = config_option(caller, "REDIS_PORT", 6379, int)
+        conn = socket.create_connection(("127.0.0.1", port))
+    conn.settimeout(2)
+    return conn
+
+
+def measure_redis_latency(caller, count=1000):
+    """PING round trips, return (p50, p99) in milliseconds."""
+    conn = _redis_connection(caller)
+    samples = []
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            conn.sendall(b"PING\r\n")
+            reply = conn.recv(64)
+            samples.append((time.perf_counter() - start) * 1000)
+            if not reply.startswith(b"+PONG"):
+                raise Exception(f"Error: unexpected redis reply {reply}")
+    finally:
+        conn.close()
+    samples.sort()
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99) - 1]
+
+
+def measure_redis_throughput(caller, requests=20000):
+    """Run redis-benchmark on the socket, return {"SET": rps, "GET": rps}"""
+    rv = subprocess.run(
+        [
+            "sudo", "redis-benchmark", "-s", redis_socket(caller),
+            "-t", "set,get", "-n", str(requests), "-q", "--csv",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    if rv.returncode != 0:
+        raise Exception("Error: redis-benchmark failed")
+    results = {}
+    for row in csv.reader(bytes.decode(rv.stdout).splitlines()):
+        if len(row) > 1 and row[0] in ("SET", "GET"):
+            results[row[0]] = float(row[1])
+    return results
+
+
+def benchmark_redis(caller):
+    """Fail the step if redis is slower than the configured floors."""
+    min_rps = config_option(caller, "REDIS_MIN_RPS", 10000, float)
+    max_p99 = config_option(caller, "REDIS_MAX_P99_MS", 5, float)
+    throughput = measure_redis_throughput(caller)
+    p50, p99 = measure_redis_latency(caller)
+    print(f"redis throughput (requests/sec): {throughput}")
+    print(f"redis PING latency: p50={p50:.3f}ms p99={p99:.3f}ms")
+    errors = []
+    for test, rps in throughput.items():
+        if rps < min_rps:
+            errors.append(f"{test} {rps:.0f} rps < {min_rps:.0f} rps")
+    if not throughput:
+        errors.append("no redis-benchmark results")
+    if p99 > max_p99:
+        errors.append(f"p99 {p99:.3f}ms > {max_p99}ms")
+    if errors:
+        raise Exception("Error: redis benchmark, " + ", ".join(errors))
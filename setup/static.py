@@ -0,0 +1,155 @@
+import gzip
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from setup.utils import config_option, host_cpu_count
+
+COMPRESSIBLE_EXTENSIONS = (
+    ".css",
+    ".js",
+    ".mjs",
+    ".map",
+    ".json",
+    ".svg",
+    ".txt",
+    ".xml",
+    ".html",
+    ".ttf",
+    ".otf",
+    ".eot",
+    ".ico",
+)
+MIN_SIZE = 256
+# written next to the source when compressing doesn't make it smaller.
+SKIP_MARKER = ".skip"
+
+
+def static_root(caller):
+    return config_option(
+        caller, "STATIC_ROOT", os.path.join(caller.project_dir, "static"))
+
+
+def _brotli():
+    """The brotli module or None, imported on use: it is installed by the
+    configs step, after this module is loaded."""
+    try:
+        return importlib.import_module("brotli")
+    except ImportError:
+        return None
+
+
+def _compress(data, suffix):
+    if suffix == ".gz":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return _brotli().compress(data, quality=11)
+
+
+def _is_current(source_stat, target):
+    """The compressed file (or its skip marker) carries the source mtime,
+    see `compress_file`."""
+    try:
+        return os.stat(target).st_mtime == source_stat.st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def compress_file(path, suffixes):
+    """Write the compressed siblings of `path`, return a list of
+    (suffix, state, original size, compressed size), state is "written",
+    "current" or "skipped" (the compressed file isn't smaller)."""
+    source_stat = os.stat(path)
+    times = (source_stat.st_atime, source_stat.st_mtime)
+    results = []
+    pending = []
+    for suffix in suffixes:
+        target = path + suffix
+        if _is_current(source_stat, target):
+            results.append(
+                (suffix, "current", source_stat.st_size,
+                 os.path.getsize(target))
+            )
+        elif _is_current(source_stat, target + SKIP_MARKER):
+            results.append(
+                (suffix, "skipped", source_stat.st_size, source_stat.st_size)
+            )
+        else:
+            pending.append(suffix)
+    if not pending:
+        return results
+
+    with open(path, "rb") as f:
+        data = f.read()
+    for suffix in pending:
+        target = path + suffix
+        compressed = _compress(data, suffix)
+        if len(compressed) >= len(data):
+            # nothing gained, let nginx serve the original & remember it.
+            _remove(target)
+            with open(target + SKIP_MARKER, "w"):
+                pass
+            os.utime(target + SKIP_MARKER, times)
+            results.append((suffix, "skipped", len(data), len(data)))
+            continue
+        _remove(target + SKIP_MARKER)
+        tmp = target + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(compressed)
+        os.utime(tmp, times)
+        os.replace(tmp, target)
+        results.append((suffix, "written", len(data), len(compressed)))
+    return results
+
+
+def compressible_files(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if not name.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, name)
+            if os.path.getsize(path) >= MIN_SIZE:
+                yield path
+
+
+def precompress_static(root, workers=None):
+    """Write .gz (& .br if the brotli package is installed) siblings for the
+    compressible files of `root`, in parallel, for nginx gzip_static."""
+    if not os.path.isdir(root):
+        raise Exception(f"Error: {root} is not a directory, run collectstatic")
+    suffixes = [".gz"]
+    if _brotli() is not None:
+        suffixes.append(".br")
+    else:
+        print("brotli is not installed, skip .br files")
+
+    files = list(compressible_files(root))
+    totals = {
+        suffix: {"written": 0, "current": 0, "skipped": 0,
+                 "original": 0, "compressed": 0}
+        for suffix in suffixes
+    }
+    with ProcessPoolExecutor(max_workers=workers or host_cpu_count()) as pool:
+        chunksize = max(len(files) // ((workers or host_cpu_count()) * 4), 1)
+        for results in pool.map(
+            compress_file, files, [suffixes] * len(files), chunksize=chunksize
+        ):
+            for suffix, state, original, compressed in results:
+                totals[suffix][state] += 1
+                totals[suffix]["original"] += original
+                totals[suffix]["compressed"] += compressed
+
+    print(f"{len(files)} compressible files in {root}")
+    for suffix, total in totals.items():
+        original, compressed = total["original"], total["compressed"]
+        print(
+            f"{suffix}: {total['written']} files written, "
+            f"{total['current']} up to date, "
+            f"{total['skipped']} not compressible, "
+            f"{original - compressed} bytes saved ({original} -> {compressed})"
+        )
+    return totals
@@ -1,14 +1,16 @@
 from typing import Any, List
+import http.client
 import importlib
 from inspect import isfunction
 import json
 import os
-import stat
 import subprocess
 import sys
+import tempfile
 import traceback
 from typing import Union, List
 import re
+import socket
 from cryptography.fernet import Fernet
 
 
@@ -131,42 +133,24 @@ def execute_shell(command: Union[str, list], shell=False):
     )
 
 
-def create_postgres_user(caller):
-    path = os.path.join(caller.current_dir, "create.sql")
-    with open(path, "w") as f:
-        txt = f"""
-#!/bin/sh
-
-psql -U postgres postgres <<OMG
- CREATE USER {caller.configs['DB_USER']} password '{caller.configs['DB_PASSWORD']}';
-OMG
-"""
-        f.write(txt)
-        print(txt)
-
-    os.chmod(path, stat.S_IEXEC)
-    print(f"sh {path}")
-    rv = execute_shell(f"sh {path}")
+def render_env_file(caller):
+    from setup.perf_profile import performance_profile
+    from setup.postgres import pgbouncer_env
 
-    if rv.returncode > 0:
-        text = rv.stderr or rv.stdout
-
-        if text:
-            text = bytes.decode(text)
-        else:
-            text = ""
-        raise Exception(f"Error: {text}")
-    else:
-        os.remove(path)
+    values = {
+        **performance_profile(caller),
+        **caller.configs,
+        "DEBUG": False,
+        **pgbouncer_env(caller),
+    }
+    return "".join([f"{key}={value}\n" for key, value in values.items()])
 
 
 def write_env_file(caller):
-    cfgs = caller.configs
     path = caller.env_path
-    cfgs["DEBUG"] = False
 
     with open(path, "w") as f:
-        f.writelines([f"{key}={value}\n" for key, value in cfgs.items()])
+        f.write(render_env_file(caller))
 
 
 def make_dir_if_not_exists(path):
@@ -175,6 +159,105 @@ def make_dir_if_not_exists(path):
     execute_shell(f"sudo mkdir -pv {path}")
 
 
+def config_option(caller, key, default=None, cast=None):
+    """Read a per host option from the remote configs, fallback to `default`.
+    The remote configs are json, so numbers may arrive as strings, pass
+    `cast` (int, float, ...) to normalize the value."""
+    value = caller.configs.get(key, None)
+    if value is None or value == "":
+        return default
+    if cast is bool and isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if cast is not None:
+        return cast(value)
+    return value
+
+
+def host_cpu_count():
+    return os.cpu_count() or 1
+
+
+def host_meminfo():
+    """Return /proc/meminfo as a dict of bytes, example: {"MemTotal": ...}"""
+    info = {}
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            parts = value.split()
+            amount = int(parts[0])
+            if len(parts) > 1 and parts[1] == "kB":
+                amount *= 1024
+            info[key] = amount
+    return info
+
+
+def format_size(amount):
+    """Format bytes as postgres/redis like size, example: 512MB, 2GB"""
+    if amount >= 1024 ** 3 and amount % 1024 ** 3 == 0:
+        return f"{amount // 1024 ** 3}GB"
+    if amount >= 1024 ** 2:
+        return f"{amount // 1024 ** 2}MB"
+    return f"{max(amount // 1024, 1)}kB"
+
+
+def read_system_file(path):
+    """Read a file that may be readable by root only, return "" if missing."""
+    if not os.path.exists(path):
+        return ""
+    if os.access(path, os.R_OK):
+        with open(path, "r") as f:
+            return f.read()
+    rv = subprocess.run(["sudo", "cat", path], stdout=subprocess.PIPE)
+    if rv.returncode != 0:
+        return ""
+    return bytes.decode(rv.stdout)
+
+
+def install_file(content, target, mode="644"):
+    """Write `content` to the system path `target` through `sudo install`.
+    Return False if the target already has the same content."""
+    if read_system_file(target) == content:
+        print(f"File up to date: {target}")
+        return False
+    tmp = tempfile.NamedTemporaryFile("w", delete=False, suffix=".aqar")
+    try:
+        tmp.write(content)
+        tmp.close()
+        rv = execute_shell(
+            ["sudo", "install", "-D", "-m", mode, tmp.name, target])
+        if rv.returncode != 0:
+            raise Exception(f"Error: can't install {target}")
+    finally:
+        os.remove(tmp.name)
+    print(f"File installed: {target}")
+    return True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over the gunicorn/daphne unix sockets."""
+
+    def __init__(self, path, timeout=10):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def unix_http_get(socket_path, path="/", host="localhost", timeout=10):
+    """GET `path` through the unix socket, return (status, headers)."""
+    conn = UnixHTTPConnection(socket_path, timeout)
+    try:
+        conn.request("GET", path, headers={"Host": host})
+        response = conn.getresponse()
+        response.read()
+        return response.status, dict(response.getheaders())
+    finally:
+        conn.close()
+
+
 def user_choice(command, caller, message=""):
     if message:
         print(message)
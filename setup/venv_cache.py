@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+from setup.utils import config_option
+
+
+def venv_cache_dir(caller):
+    """The snapshots dir, mount a shared dir here to reuse the snapshots
+    between the servers."""
+    return config_option(
+        caller,
+        "VENV_CACHE_DIR",
+        os.path.join(caller.home_dir, ".cache", "aqar-setup", "venvs"),
+    )
+
+
+def _python_version():
+    rv = subprocess.run(
+        ["python3", "-c", "import platform; print(platform.python_version())"],
+        stdout=subprocess.PIPE,
+    )
+    return bytes.decode(rv.stdout).strip()
+
+
+def venv_cache_key(caller):
+    """Hash of poetry.lock + the python version + the arch, None if there
+    is no poetry.lock"""
+    lock = os.path.join(caller.project_dir, "poetry.lock")
+    if not os.path.exists(lock):
+        return None
+    digest = hashlib.sha256()
+    with open(lock, "rb") as f:
+        digest.update(f.read())
+    digest.update(_python_version().encode())
+    digest.update(platform.machine().encode())
+    return digest.hexdigest()[:32]
+
+
+def _snapshot_paths(caller, key):
+    base = os.path.join(venv_cache_dir(caller), key)
+    return base + ".tar.gz", base + ".json"
+
+
+def save_venv_snapshot(caller):
+    key = venv_cache_key(caller)
+    if key is None:
+        print("no poetry.lock, skip the venv snapshot")
+        return
+    archive, meta = _snapshot_paths(caller, key)
+    if os.path.exists(archive):
+        print(f"venv snapshot exists: {archive}")
+        return
+    os.makedirs(os.path.dirname(archive), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(archive), suffix=".tmp")
+    os.close(fd)
+    try:
+        with tarfile.open(tmp, "w:gz") as tar:
+            tar.add(caller.venv_path, arcname=".")
+        os.replace(tmp, archive)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    with open(meta, "w") as f:
+        json.dump(
+            {"venv_path": caller.venv_path, "project_dir": caller.project_dir},
+            f,
+        )
+    print(f"venv snapshot saved: {archive}")
+
+
+def relocate_venv(venv_path, replacements):
+    """Rewrite the absolute paths (`replacements` maps old to new) of the
+    scripts, activate files & the .pth files (the editable install of the
+    project)."""
+    candidates = []
+    bin_dir = os.path.join(venv_path, "bin")
+    for name in os.listdir(bin_dir):
+        candidates.append(os.path.join(bin_dir, name))
+    for dirpath, dirnames, filenames in os.walk(os.path.join(venv_path, "lib")):
+        if dirpath.endswith("site-packages"):
+            candidates.extend(
+                os.path.join(dirpath, name)
+                for name in filenames
+                if name.endswith(".pth")
+            )
+            dirnames[:] = []
+
+    # one pass, the new paths may contain the old ones.
+    pattern = re.compile(
+        b"|".join(
+            re.escape(old.encode())
+            for old in sorted(replacements, key=len, reverse=True)
+        )
+    )
+    for path in candidates:
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            content = f.read()
+        if b"\0" in content[:1024]:
+            continue
+        updated = pattern.sub(
+            lambda match: replacements[match.group().decode()].encode(),
+            content,
+        )
+        if updated != content:
+            with open(path, "wb") as f:
+                f.write(updated)
+
+
+def restore_venv_snapshot(caller):
+    """Extract the snapshot of the current key into `venv_path`,
+    return True if restored."""
+    key = venv_cache_key(caller)
+    if key is None:
+        return False
+    archive, meta = _snapshot_paths(caller, key)
+    if not os.path.exists(archive) or not os.path.exists(meta):
+        print(f"no venv snapshot for {key}")
+        return False
+    with open(meta, "r") as f:
+        origin = json.load(f)
+
+    if os.path.exists(caller.venv_path):
+        shutil.rmtree(caller.venv_path)
+    # the "data" filter refuses the absolute bin/python -> /usr/bin/python3
+    # link, "tar" keeps it & still refuses the members outside the venv.
+    extract = {"filter": "tar"} if hasattr(tarfile, "data_filter") else {}
+    try:
+        with tarfile.open(archive, "r:gz") as tar:
+            tar.extractall(caller.venv_path, **extract)
+    except (tarfile.TarError, OSError) as e:
+        print(f"can't extract {archive} ({e}), install from scratch")
+        shutil.rmtree(caller.venv_path, ignore_errors=True)
+        return False
+    replacements = {
+        origin["venv_path"]: caller.venv_path,
+        origin["project_dir"]: caller.project_dir,
+    }
+    replacements = {old: new for old, new in replacements.items() if old != new}
+    if replacements:
+        relocate_venv(caller.venv_path, replacements)
+
+    rv = subprocess.run(
+        [os.path.join(caller.venv_path, "bin", "python"), "-c", "import sys"])
+    if rv.returncode != 0:
+        print("the restored venv is broken, install from scratch")
+        shutil.rmtree(caller.venv_path)
+        return False
+    print(f"venv restored from {archive}")
+    return True
@@ -0,0 +1,192 @@
+import os
+import statistics
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from setup.nginx import nginx_options
+from setup.utils import config_option, install_file, unix_http_get
+
+PRELOAD_DROPIN = "/etc/systemd/system/gunicorn.service.d/aqar-preload.conf"
+
+
+def health_host(caller):
+    """The Host header of the requests sent to the sockets, django rejects
+    the hosts that are not in ALLOWED_HOSTS."""
+    hosts = config_option(caller, "ALLOWED_HOSTS", "localhost")
+    if isinstance(hosts, (list, tuple)):
+        hosts = ",".join(hosts)
+    hosts = [h.strip() for h in hosts.replace(" ", ",").split(",") if h.strip()]
+    host = next((h for h in hosts if h != "*"), "localhost")
+    return config_option(caller, "HEALTH_CHECK_HOST", host.lstrip("."))
+
+
+def warmup_paths(caller):
+    paths = config_option(caller, "WARMUP_PATHS", "/")
+    if isinstance(paths, str):
+        paths = paths.split(",")
+    return [p.strip() for p in paths if p.strip()]
+
+
+def gunicorn_preload(caller):
+    return config_option(caller, "GUNICORN_PRELOAD", False, bool)
+
+
+def gunicorn_preloaded():
+    """Whether the installed unit preloads the app, the drop-in may be left
+    by a previous run with GUNICORN_PRELOAD on."""
+    return os.path.exists(PRELOAD_DROPIN)
+
+
+def install_gunicorn_preload(caller):
+    """Load the app once in the master before forking the workers, or
+    remove the drop-in when GUNICORN_PRELOAD is off. With preload, HUP
+    can't load new code, the gunicorn service must be restarted."""
+    if not gunicorn_preload(caller):
+        if gunicorn_preloaded():
+            subprocess.run(["sudo", "rm", "-f", PRELOAD_DROPIN])
+            subprocess.run(["sudo", "systemctl", "daemon-reload"])
+            print(f"File removed: {PRELOAD_DROPIN}")
+        return
+    install_file(
+        '[Service]\nEnvironment="GUNICORN_CMD_ARGS=--preload"\n',
+        PRELOAD_DROPIN,
+    )
+    subprocess.run(["sudo", "systemctl", "daemon-reload"])
+
+
+def _main_pid(unit):
+    rv = subprocess.run(
+        ["systemctl", "show", "-p", "MainPID", "--value", unit],
+        stdout=subprocess.PIPE,
+    )
+    return int(bytes.decode(rv.stdout).strip() or 0)
+
+
+def _children(pid):
+    path = f"/proc/{pid}/task/{pid}/children"
+    try:
+        with open(path, "r") as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def _cpu_ticks(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except FileNotFoundError:
+        return None
+    # utime & stime, the 14th & 15th fields of /proc/<pid>/stat
+    return int(fields[11]) + int(fields[12])
+
+
+def service_workers(unit):
+    """The gunicorn workers are the children of the master, daphne serves
+    from its main process."""
+    main = _main_pid(unit)
+    if not main:
+        return []
+    return _children(main) or [main]
+
+
+def _timed_get(socket_path, path, host):
+    start = time.perf_counter()
+    try:
+        status, headers = unix_http_get(socket_path, path, host)
+    except OSError as e:
+        status = e
+    return status, (time.perf_counter() - start) * 1000
+
+
+def _ok(status):
+    return isinstance(status, int) and status < 500
+
+
+def warmup(caller, unit, socket_path, rounds=None, samples=20):
+    """Send warmup requests through the socket until every worker has
+    served at least one (its CPU time moved), report the cold & warm
+    latency (ms) of the successful responses. Fail if no request
+    succeeds."""
+    host = health_host(caller)
+    paths = warmup_paths(caller)
+    rounds = rounds or config_option(caller, "WARMUP_ROUNDS", 20, int)
+
+    status, cold = _timed_get(socket_path, paths[0], host)
+    print(f"{unit} cold request {paths[0]}: {status} in {cold:.1f}ms")
+    if not _ok(status):
+        print(f"Warning: {unit} cold request failed: {status}")
+        cold = None
+
+    workers = service_workers(unit)
+    warmed = set()
+    succeeded = 0
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max(len(workers), 1) * 2) as pool:
+        for _ in range(rounds):
+            before = {pid: _cpu_ticks(pid) for pid in workers}
+            requests = [
+                pool.submit(_timed_get, socket_path, path, host)
+                for path in paths
+                for _ in range(max(len(workers), 1) * 2)
+            ]
+            for request in requests:
+                status = request.result()[0]
+                if _ok(status):
+                    succeeded += 1
+                else:
+                    failures[str(status)] = failures.get(str(status), 0) + 1
+            warmed |= {
+                pid
+                for pid in workers
+                if before[pid] is not None
+                and (_cpu_ticks(pid) or 0) > before[pid]
+            }
+            if workers and warmed >= set(workers):
+                break
+    if failures:
+        print(f"Warning: {unit} failed warmup requests: {failures}")
+    if not succeeded:
+        raise Exception(f"Error: every warmup request to {unit} failed")
+
+    results = [
+        _timed_get(socket_path, paths[i % len(paths)], host)
+        for i in range(samples)
+    ]
+    latencies = sorted(latency for status, latency in results if _ok(status))
+    if not latencies:
+        raise Exception(f"Error: every latency sample of {unit} failed")
+    warm = statistics.median(latencies)
+    p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+    cold_text = "failed" if cold is None else f"{cold:.1f}ms"
+    print(
+        f"{unit}: {len(warmed)}/{len(workers)} workers warmed, "
+        f"cold {cold_text}, warm median {warm:.1f}ms p95 {p95:.1f}ms "
+        f"({len(latencies)}/{samples} samples)"
+    )
+    if not workers:
+        print(f"{unit}: no worker found, can't verify the warmup")
+    elif not warmed >= set(workers):
+        print(
+            f"Warning: {unit} workers without a warmup request: "
+            f"{sorted(set(workers) - warmed)}"
+        )
+    return {
+        "cold": cold,
+        "warm": warm,
+        "p95": p95,
+        "warmed": len(warmed),
+        "workers": len(workers),
+        "failed": sum(failures.values()),
+    }
+
+
+def warmup_gunicorn(caller):
+    socket_path = nginx_options(caller)["gunicorn_socket"]
+    return warmup(caller, "gunicorn.service", socket_path)
+
+
+def warmup_daphne(caller):
+    socket_path = nginx_options(caller)["daphne_socket"]
+    return warmup(caller, "daphne.service", socket_path)
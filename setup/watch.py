@@ -0,0 +1,183 @@
+import os
+import time
+
+from setup.nginx import nginx_context
+from setup.utils import (
+    execute_shell,
+    install_file,
+    read_system_file,
+    resolve_template_file,
+)
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+DEBOUNCE = 0.3
+POLL_INTERVAL = 0.25
+
+# config/<path> -> how to install it & reload the affected service only.
+WATCHED = {
+    "gunicorn/gunicorn.service.template": {
+        "target": "/etc/systemd/system/gunicorn.service",
+        "validate": "systemd",
+        # HUP keeps the old unit (ExecStart, Environment, the preload
+        # drop-in), restart it, the socket holds the new connections.
+        "reload": [
+            "sudo systemctl daemon-reload",
+            "sudo systemctl restart gunicorn.service",
+        ],
+    },
+    "gunicorn/gunicorn.socket": {
+        "target": "/etc/systemd/system/gunicorn.socket",
+        "validate": "systemd",
+        # daemon-reload doesn't rebind a listening socket.
+        "reload": [
+            "sudo systemctl daemon-reload",
+            "sudo systemctl restart gunicorn.socket",
+        ],
+    },
+    "daphne/daphne.service.template": {
+        "target": "/etc/systemd/system/daphne.service",
+        "validate": "systemd",
+        # the socket stays open, the new connections wait for the restart.
+        "reload": [
+            "sudo systemctl daemon-reload",
+            "sudo systemctl restart daphne.service",
+        ],
+    },
+    "daphne/daphne.socket": {
+        "target": "/etc/systemd/system/daphne.socket",
+        "validate": "systemd",
+        "reload": [
+            "sudo systemctl daemon-reload",
+            "sudo systemctl restart daphne.socket",
+        ],
+    },
+    "nginx/aqar.template": {
+        "target": "/etc/nginx/sites-available/aqar",
+        "validate": "nginx",
+        "reload": ["sudo systemctl reload nginx"],
+    },
+}
+
+
+def _snapshot(root):
+    mtimes = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                pass
+    return mtimes
+
+
+def poll_changes(root, debounce=DEBOUNCE, interval=POLL_INTERVAL):
+    """Yield the set of changed paths, a burst of edits is yielded once
+    after `debounce` seconds without changes."""
+    previous = _snapshot(root)
+    pending = set()
+    last_change = None
+    while True:
+        time.sleep(interval)
+        current = _snapshot(root)
+        changed = {
+            path
+            for path in set(previous) | set(current)
+            if previous.get(path) != current.get(path)
+        }
+        previous = current
+        if changed:
+            pending |= changed
+            last_change = time.monotonic()
+        elif pending and time.monotonic() - last_change >= debounce:
+            yield pending
+            pending = set()
+
+
+def inotify_changes(root, debounce=DEBOUNCE):
+    inotify = INotify()
+    mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE
+    directories = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        directories[inotify.add_watch(dirpath, mask)] = dirpath
+    while True:
+        events = inotify.read()
+        pending = set()
+        while events:
+            for event in events:
+                if event.name:
+                    pending.add(os.path.join(directories[event.wd], event.name))
+            # keep reading until the burst ends.
+            events = inotify.read(timeout=int(debounce * 1000))
+        if pending:
+            yield pending
+
+
+def _validate(kind, path):
+    if kind == "systemd":
+        return execute_shell(["systemd-analyze", "verify", path]).returncode == 0
+    if kind == "nginx":
+        return execute_shell("sudo nginx -t").returncode == 0
+    return True
+
+
+def apply_config(caller, config_dir, relative):
+    """Render `relative` with the context, validate, install & reload,
+    the previous file is restored if the validation fails."""
+    spec = WATCHED[relative]
+    source = os.path.join(config_dir, relative)
+    ctx = caller.context
+    if relative.startswith("nginx/"):
+        ctx = {**ctx, **nginx_context(caller)}
+    if source.endswith(".template"):
+        resolve_template_file(source, ctx)
+        source = source[: -len(".template")]
+    with open(source, "r") as f:
+        content = f.read()
+
+    if spec["validate"] == "systemd" and not _validate("systemd", source):
+        print(f"Error: {relative} is invalid, not installed")
+        return False
+    previous = read_system_file(spec["target"])
+    if not install_file(content, spec["target"]):
+        return True
+    if spec["validate"] == "nginx" and not _validate("nginx", spec["target"]):
+        print(f"Error: {relative} is invalid, restore the previous file")
+        if previous:
+            install_file(previous, spec["target"])
+        else:
+            execute_shell(["sudo", "rm", "-f", spec["target"]])
+        return False
+    for command in spec["reload"]:
+        execute_shell(command)
+    return True
+
+
+def watch(caller):
+    """Re-render & reload the changed configs until CTRL+C."""
+    config_dir = os.path.join(caller.project_dir, "config")
+    caller.configs
+    if INotify is not None:
+        changes = inotify_changes(config_dir)
+        print(f"watching {config_dir} (inotify), CTRL+C to stop")
+    else:
+        changes = poll_changes(config_dir)
+        print(f"watching {config_dir} (polling), CTRL+C to stop")
+    try:
+        for paths in changes:
+            start = time.monotonic()
+            relatives = sorted(
+                {os.path.relpath(path, config_dir) for path in paths}
+                & set(WATCHED)
+            )
+            for relative in relatives:
+                print(f"changed: {relative}")
+                apply_config(caller, config_dir, relative)
+            if relatives:
+                print(f"applied in {time.monotonic() - start:.2f}s")
+    except KeyboardInterrupt:
+        print("stop watching")